@@ -0,0 +1,457 @@
+## -*- coding: UTF-8 -*-
+## lookup.py
+##
+## Copyright (c) 2018 analyzeDFIR
+##
+## Permission is hereby granted, free of charge, to any person obtaining a copy
+## of this software and associated documentation files (the "Software"), to deal
+## in the Software without restriction, including without limitation the rights
+## to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is
+## furnished to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+## FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+## AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+## LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+## OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+## SOFTWARE.
+
+import mmap
+from array import array
+from struct import Struct as _PackedStruct
+
+__all__ = [
+    'MFTFixedKeyTable',
+    'MFTLookupIndex',
+    'pack_file_reference'
+]
+
+'''
+Raw field layouts used while scanning entries. These mirror the offsets of
+MFTEntryHeader, MFTAttributeHeader and MFTResidentAttributeData (see headers.py)
+but are read with struct directly so that building an index over a full $MFT
+doesn't require parsing every entry into a Container.
+'''
+_ENTRY_SIGNATURE = b'FILE'
+_ENTRY_HEADER = _PackedStruct('<4sHHQHHHH')
+_BASE_FILE_RECORD_SEGMENT = _PackedStruct('<Q')
+_ATTRIBUTE_HEADER = _PackedStruct('<IIB')
+_RESIDENT_ATTRIBUTE_DATA = _PackedStruct('<IH')
+_UINT32 = _PackedStruct('<I')
+_MINIMUM_ATTRIBUTE_LENGTH = 24
+_OBJECT_ID_TYPE_CODE = 0x00000040
+_END_OF_ATTRIBUTES = 0xFFFFFFFF
+_SEQUENCE_STRIDE = 512
+_NULL_GUID = bytes(16)
+
+def pack_file_reference(record_number, sequence_number):
+    '''
+    Args:
+        record_number: Integer  => MFT record (segment) number (48 bits)
+        sequence_number: Integer    => MFT entry sequence number (16 bits)
+    Returns:
+        Bytes
+        8-byte key in the same layout as NTFSFileReference on disk, so raw
+        references lifted from $UsnJrnl records, link files, etc. can be used
+        as keys directly
+    '''
+    return (
+        (record_number & 0xFFFFFFFFFFFF) | ((sequence_number & 0xFFFF) << 48)
+    ).to_bytes(8, 'little')
+
+def _coerce_key(key):
+    '''
+    Args:
+        key: Bytes-like => raw binary key
+    Returns:
+        Bytes
+        key as immutable bytes
+    Preconditions:
+        key is bytes, bytearray or memoryview (raises TypeError otherwise)
+    '''
+    if isinstance(key, (bytes, bytearray, memoryview)):
+        return bytes(key)
+    raise TypeError('expected bytes-like key, got %s'%type(key).__name__)
+
+def _coerce_file_reference(reference):
+    '''
+    Args:
+        reference: Bytes|Tuple<Integer, Integer>|Integer    => raw 8-byte NTFSFileReference,
+                                                               (record number, sequence number)
+                                                               or 64-bit NTFSFileReference value
+    Returns:
+        Bytes
+        8-byte file reference key (see pack_file_reference)
+    Preconditions:
+        reference is bytes-like, a tuple or an integer (raises TypeError otherwise)
+    '''
+    if isinstance(reference, tuple):
+        return pack_file_reference(*reference)
+    if isinstance(reference, int) and not isinstance(reference, bool):
+        return reference.to_bytes(8, 'little')
+    return _coerce_key(reference)
+
+class MFTFixedKeyTable(object):
+    '''
+    Open addressing (linear probing) hash table mapping fixed-size binary keys
+    to non-negative integer values (MFT entry offsets). Keys are stored back to
+    back in a single bytearray and values in a signed 64-bit array, so the table
+    costs key_size + 8 bytes per slot rather than a dict of Python objects.
+    Inserting a key that is already present keeps the original value.
+    '''
+    _EMPTY = -1
+    _MAX_LOAD_NUMERATOR = 1
+    _MAX_LOAD_DENOMINATOR = 2
+
+    def __init__(self, key_size, capacity=1024):
+        '''
+        Args:
+            key_size: Integer   => size of each key in bytes
+            capacity: Integer   => expected number of keys
+        '''
+        if key_size <= 0:
+            raise ValueError('key_size must be a positive integer')
+        self.key_size = key_size
+        self._count = 0
+        self._allocate(self._slot_count_for(capacity))
+    def _slot_count_for(self, capacity):
+        '''
+        Args:
+            capacity: Integer   => number of keys to hold
+        Returns:
+            Integer
+            smallest power of two number of slots that holds capacity keys
+            without exceeding the maximum load factor
+        '''
+        slots = 8
+        minimum = capacity * self._MAX_LOAD_DENOMINATOR // self._MAX_LOAD_NUMERATOR
+        while slots < minimum:
+            slots <<= 1
+        return slots
+    def _allocate(self, slots):
+        '''
+        Args:
+            slots: Integer  => number of slots (power of two)
+        Procedure:
+            Replace the key and value storage with empty storage of the given size
+        '''
+        self._mask = slots - 1
+        self._keys = bytearray(slots * self.key_size)
+        self._values = array('q', [self._EMPTY]) * slots
+    def _grow(self):
+        '''
+        Procedure:
+            Double the number of slots and reinsert every stored key
+        '''
+        key_size = self.key_size
+        keys, values = self._keys, self._values
+        self._allocate((self._mask + 1) << 1)
+        self._count = 0
+        for slot, value in enumerate(values):
+            if value != self._EMPTY:
+                start = slot * key_size
+                self.insert(bytes(keys[start:start + key_size]), value)
+    def _find_slot(self, key):
+        '''
+        Args:
+            key: Bytes  => key to locate
+        Returns:
+            Integer
+            slot holding key, or the empty slot where it would be inserted
+        '''
+        key_size = self.key_size
+        keys, values, mask = self._keys, self._values, self._mask
+        slot = hash(key) & mask
+        while True:
+            if values[slot] == self._EMPTY:
+                return slot
+            start = slot * key_size
+            if keys[start:start + key_size] == key:
+                return slot
+            slot = (slot + 1) & mask
+    def insert(self, key, value):
+        '''
+        Args:
+            key: Bytes      => key of length key_size
+            value: Integer  => non-negative value to associate with key
+        Returns:
+            Boolean
+            True if key was added, False if it was already present
+        '''
+        key = _coerce_key(key)
+        if len(key) != self.key_size:
+            raise ValueError('expected key of %d bytes, got %d'%(self.key_size, len(key)))
+        if value < 0:
+            raise ValueError('value must be non-negative')
+        if (self._count + 1) * self._MAX_LOAD_DENOMINATOR > \
+            (self._mask + 1) * self._MAX_LOAD_NUMERATOR:
+            self._grow()
+        slot = self._find_slot(key)
+        if self._values[slot] != self._EMPTY:
+            return False
+        start = slot * self.key_size
+        self._keys[start:start + self.key_size] = key
+        self._values[slot] = value
+        self._count += 1
+        return True
+    def get(self, key, default=None):
+        '''
+        Args:
+            key: Bytes          => key to look up
+            default: Any        => value to return if key is not present
+        Returns:
+            Integer
+            value associated with key, or default
+        '''
+        key = _coerce_key(key)
+        if len(key) != self.key_size:
+            return default
+        value = self._values[self._find_slot(key)]
+        return default if value == self._EMPTY else value
+    def get_many(self, keys, default=None):
+        '''
+        Args:
+            keys: Iterable<Bytes>   => keys to look up
+            default: Any            => value to use for keys that are not present
+        Returns:
+            List<Integer>
+            values associated with each key, in order
+        '''
+        key_size, empty = self.key_size, self._EMPTY
+        table_keys, values, mask = self._keys, self._values, self._mask
+        results = list()
+        append = results.append
+        for key in keys:
+            key = _coerce_key(key)
+            if len(key) != key_size:
+                append(default)
+                continue
+            slot = hash(key) & mask
+            while True:
+                value = values[slot]
+                if value == empty:
+                    append(default)
+                    break
+                start = slot * key_size
+                if table_keys[start:start + key_size] == key:
+                    append(value)
+                    break
+                slot = (slot + 1) & mask
+        return results
+    def __contains__(self, key):
+        return self.get(key) is not None
+    def __len__(self):
+        return self._count
+
+class MFTLookupIndex(object):
+    '''
+    Reverse lookup index from MFTObjectID GUIDs and NTFSFileReference values to
+    byte offsets of MFT entries, built with a single pass over raw $MFT data.
+        object_ids:         MFTObjectID.ObjectID => offset of owning (base) entry
+        birth_object_ids:   MFTObjectID.BirthObjectID => offset of owning (base) entry
+        file_references:    (record number, sequence number) => offset of entry
+    NOTE:
+        BirthVolumeID is not indexed, as it is shared by every file created on
+        the same volume and so doesn't identify a single entry. Null GUIDs are
+        skipped, and the first entry seen for a given key wins.
+    '''
+
+    def __init__(self, entry_size=1024, capacity=1024):
+        '''
+        Args:
+            entry_size: Integer => size of each MFT entry in bytes
+            capacity: Integer   => expected number of entries
+        NOTE:
+            only file_references is pre-sized from capacity, as few entries have an
+            $OBJECT_ID attribute and the GUID tables grow on demand
+        '''
+        self.entry_size = entry_size
+        self.object_ids = MFTFixedKeyTable(16)
+        self.birth_object_ids = MFTFixedKeyTable(16)
+        self.file_references = MFTFixedKeyTable(8, capacity)
+    @classmethod
+    def from_buffer(cls, buffer, entry_size=1024, base_offset=0):
+        '''
+        Args:
+            buffer: Bytes-like      => raw $MFT data
+            entry_size: Integer     => size of each MFT entry in bytes
+            base_offset: Integer    => offset of buffer relative to start of $MFT
+        Returns:
+            MFTLookupIndex
+            index over every entry in buffer
+        '''
+        index = cls(entry_size=entry_size, capacity=len(buffer) // entry_size)
+        view = memoryview(buffer)
+        try:
+            for position in range(0, len(view) - entry_size + 1, entry_size):
+                index.add_entry(base_offset + position, view[position:position + entry_size])
+        finally:
+            view.release()
+        return index
+    @classmethod
+    def from_file(cls, path, entry_size=1024):
+        '''
+        Args:
+            path: String            => path to extracted $MFT file
+            entry_size: Integer     => size of each MFT entry in bytes
+        Returns:
+            MFTLookupIndex
+            index over every entry in $MFT file at path
+        '''
+        with open(path, 'rb') as mft_file:
+            if mft_file.seek(0, 2) == 0:
+                return cls(entry_size=entry_size)
+            with mmap.mmap(mft_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return cls.from_buffer(buffer, entry_size=entry_size)
+    def _apply_fixups(self, entry, sequence_array_offset, sequence_array_size):
+        '''
+        Args:
+            entry: Bytes-like                   => raw MFT entry
+            sequence_array_offset: Integer      => see MFTEntryMultiSectorHeader
+            sequence_array_size: Integer        => see MFTEntryMultiSectorHeader
+        Returns:
+            Bytearray
+            copy of entry with update sequence array values restored to the end
+            of each sector, or None if the update sequence array lies outside the
+            entry or a sector doesn't end with the update sequence number (torn write)
+        '''
+        entry = bytearray(entry)
+        if sequence_array_size < 2:
+            return entry
+        if sequence_array_offset + sequence_array_size * 2 > len(entry):
+            return None
+        update_sequence_number = entry[sequence_array_offset:sequence_array_offset + 2]
+        for sector in range(1, sequence_array_size):
+            end = sector * _SEQUENCE_STRIDE
+            if end > len(entry):
+                break
+            if entry[end - 2:end] != update_sequence_number:
+                return None
+            fixup = sequence_array_offset + sector * 2
+            entry[end - 2:end] = entry[fixup:fixup + 2]
+        return entry
+    def add_entry(self, offset, entry):
+        '''
+        Args:
+            offset: Integer         => offset of entry from start of $MFT in bytes
+            entry: Bytes-like       => raw MFT entry of length entry_size
+        Returns:
+            Boolean
+            True if entry had a valid FILE signature and update sequence array
+            and was indexed
+        '''
+        if len(entry) < _ENTRY_HEADER.size + _BASE_FILE_RECORD_SEGMENT.size + 8:
+            return False
+        (
+            signature,
+            sequence_array_offset,
+            sequence_array_size,
+            _,
+            sequence_number,
+            _,
+            first_attribute_offset,
+            _
+        ) = _ENTRY_HEADER.unpack_from(entry, 0)
+        if signature != _ENTRY_SIGNATURE:
+            return False
+        entry = self._apply_fixups(entry, sequence_array_offset, sequence_array_size)
+        if entry is None:
+            return False
+        record_number = offset // self.entry_size
+        self.file_references.insert(pack_file_reference(record_number, sequence_number), offset)
+        base_record_number = _BASE_FILE_RECORD_SEGMENT.unpack_from(entry, 0x20)[0] & 0xFFFFFFFFFFFF
+        owner_offset = offset if base_record_number == 0 else base_record_number * self.entry_size
+        used_size = min(len(entry), _UINT32.unpack_from(entry, 0x18)[0] or len(entry))
+        if first_attribute_offset < _ENTRY_HEADER.size or first_attribute_offset > used_size:
+            return True
+        attribute_offset = first_attribute_offset
+        while attribute_offset + _ATTRIBUTE_HEADER.size <= used_size:
+            type_code, record_length, form_code = _ATTRIBUTE_HEADER.unpack_from(entry, attribute_offset)
+            if type_code == _END_OF_ATTRIBUTES or record_length < _MINIMUM_ATTRIBUTE_LENGTH or \
+                attribute_offset + record_length > used_size:
+                break
+            if type_code == _OBJECT_ID_TYPE_CODE and form_code == 0:
+                value_length, value_offset = _RESIDENT_ATTRIBUTE_DATA.unpack_from(entry, attribute_offset + 16)
+                start = attribute_offset + value_offset
+                end = min(start + value_length, attribute_offset + record_length)
+                if end - start >= 16:
+                    self._insert_guid(self.object_ids, entry[start:start + 16], owner_offset)
+                if end - start >= 48:
+                    self._insert_guid(self.birth_object_ids, entry[start + 32:start + 48], owner_offset)
+            attribute_offset += record_length
+        return True
+    def _insert_guid(self, table, guid, offset):
+        '''
+        Args:
+            table: MFTFixedKeyTable => table to insert into
+            guid: Bytes-like        => raw 16-byte NTFSGUID
+            offset: Integer         => offset of owning entry
+        Procedure:
+            Insert guid into table unless it is the null GUID
+        '''
+        guid = bytes(guid)
+        if guid != _NULL_GUID:
+            table.insert(guid, offset)
+    def lookup_object_id(self, guid, default=None):
+        '''
+        Args:
+            guid: Bytes-like    => raw 16-byte ObjectID (or BirthObjectID) GUID
+            default: Any        => value to return if guid is not indexed
+        Returns:
+            Integer
+            offset of entry owning guid, checking ObjectID first and then
+            BirthObjectID, or default
+        '''
+        offset = self.object_ids.get(guid)
+        if offset is None:
+            offset = self.birth_object_ids.get(guid, default)
+        return offset
+    def lookup_object_ids(self, guids, default=None):
+        '''
+        Args:
+            guids: Iterable<Bytes-like> => raw 16-byte GUIDs
+            default: Any            => value to use for guids that are not indexed
+        Returns:
+            List<Integer>
+            see lookup_object_id, in order of guids
+        '''
+        guids = [_coerce_key(guid) for guid in guids]
+        offsets = self.object_ids.get_many(guids)
+        missing = [position for position, offset in enumerate(offsets) if offset is None]
+        if len(missing) > 0:
+            fallback = self.birth_object_ids.get_many(
+                [guids[position] for position in missing], default
+            )
+            for position, offset in zip(missing, fallback):
+                offsets[position] = offset
+        return offsets
+    def lookup_file_reference(self, reference, default=None):
+        '''
+        Args:
+            reference: Bytes|Tuple<Integer, Integer>|Integer    => see _coerce_file_reference
+            default: Any                                        => value to return if reference
+                                                                   is not indexed
+        Returns:
+            Integer
+            offset of entry matching reference, or default
+        '''
+        return self.file_references.get(_coerce_file_reference(reference), default)
+    def lookup_file_references(self, references, default=None):
+        '''
+        Args:
+            references: Iterable<Bytes|Tuple<Integer, Integer>|Integer> => see lookup_file_reference
+            default: Any                                                => value to use for references
+                                                                           that are not indexed
+        Returns:
+            List<Integer>
+            see lookup_file_reference, in order of references
+        '''
+        return self.file_references.get_many(
+            (_coerce_file_reference(reference) for reference in references),
+            default
+        )
@@ -29,3 +29,4 @@ from .object_id import *
 from .security_descriptor import *
 from .volume_information import *
 from .index import *
+from .lookup import *
@@ -0,0 +1,196 @@
+## -*- coding: UTF-8 -*-
+## test_lookup.py
+##
+## Copyright (c) 2018 analyzeDFIR
+##
+## Permission is hereby granted, free of charge, to any person obtaining a copy
+## of this software and associated documentation files (the "Software"), to deal
+## in the Software without restriction, including without limitation the rights
+## to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is
+## furnished to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+## FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+## AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+## LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+## OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+## SOFTWARE.
+
+import os
+import sys
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lookup import MFTFixedKeyTable, MFTLookupIndex, pack_file_reference
+
+ENTRY_SIZE = 1024
+USA_OFFSET = 0x30
+USN = b'\x07\x00'
+FIRST_ATTRIBUTE_OFFSET = 0x38
+
+def guid(value):
+    return bytes([value]) * 16
+
+def build_entry(
+    sequence_number=1,
+    object_id=None,
+    birth_object_id=None,
+    base_record_number=0,
+    object_id_offset=FIRST_ATTRIBUTE_OFFSET,
+    raw_attribute=None,
+    tear_sector=None
+):
+    '''
+    Build a synthetic FILE record with an optional resident $OBJECT_ID attribute,
+    protected by an update sequence array covering both 512-byte sectors
+    '''
+    entry = bytearray(ENTRY_SIZE)
+    struct.pack_into('<4sHHQHHHH', entry, 0,
+        b'FILE', USA_OFFSET, 3, 0, sequence_number, 1, FIRST_ATTRIBUTE_OFFSET, 1)
+    struct.pack_into('<I', entry, 0x1C, ENTRY_SIZE)
+    struct.pack_into('<Q', entry, 0x20,
+        base_record_number | ((1 << 48) if base_record_number else 0))
+    entry[USA_OFFSET:USA_OFFSET + 2] = USN
+    offset = FIRST_ATTRIBUTE_OFFSET
+    if object_id_offset != FIRST_ATTRIBUTE_OFFSET:
+        ## pad with an unrelated resident attribute up to object_id_offset
+        struct.pack_into('<IIB', entry, offset, 0x80, object_id_offset - offset, 0)
+        offset = object_id_offset
+    if raw_attribute is not None:
+        entry[offset:offset + len(raw_attribute)] = raw_attribute
+        offset += len(raw_attribute)
+    elif object_id is not None:
+        value = object_id + guid(0xEE) + (birth_object_id or bytes(16)) + bytes(16)
+        struct.pack_into('<IIBBHHHIHB', entry, offset,
+            0x40, 24 + len(value), 0, 0, 0, 0, 0, len(value), 24, 0)
+        entry[offset + 24:offset + 24 + len(value)] = value
+        offset += 24 + len(value)
+    struct.pack_into('<I', entry, offset, 0xFFFFFFFF)
+    struct.pack_into('<I', entry, 0x18, min(offset + 8, ENTRY_SIZE))
+    for sector in (1, 2):
+        end = sector * 512
+        fixup = USA_OFFSET + sector * 2
+        entry[fixup:fixup + 2] = entry[end - 2:end]
+        entry[end - 2:end] = USN
+    if tear_sector is not None:
+        end = tear_sector * 512
+        entry[end - 2:end] = b'\x08\x00'
+    return bytes(entry)
+
+def test_fixups_restore_sector_ends():
+    ## place the ObjectID value so that it straddles the end of the first sector
+    object_id = bytes(range(1, 17))
+    entry = build_entry(object_id=object_id, object_id_offset=512 - 24 - 8)
+    assert entry[510:512] == USN
+    index = MFTLookupIndex.from_buffer(entry)
+    assert index.lookup_object_id(object_id) == 0
+
+def test_torn_write_is_not_indexed():
+    entry = build_entry(object_id=guid(1), tear_sector=2)
+    index = MFTLookupIndex.from_buffer(entry)
+    assert index.lookup_object_id(guid(1)) is None
+    assert index.lookup_file_reference((0, 1)) is None
+
+def test_file_references():
+    buffer = build_entry(sequence_number=3) + build_entry(sequence_number=9)
+    index = MFTLookupIndex.from_buffer(buffer)
+    assert index.lookup_file_reference((1, 9)) == ENTRY_SIZE
+    assert index.lookup_file_reference(pack_file_reference(1, 9)) == ENTRY_SIZE
+    assert index.lookup_file_reference((9 << 48) | 1) == ENTRY_SIZE
+    assert index.lookup_file_reference((1, 3)) is None
+    assert index.lookup_file_reference(8) is None
+
+def test_extension_record_maps_to_base_entry():
+    buffer = build_entry() + build_entry() + build_entry(object_id=guid(5), base_record_number=1)
+    index = MFTLookupIndex.from_buffer(buffer)
+    assert index.lookup_object_id(guid(5)) == ENTRY_SIZE
+    assert index.lookup_file_reference((2, 1)) == 2 * ENTRY_SIZE
+
+def test_null_guids_are_skipped():
+    index = MFTLookupIndex.from_buffer(build_entry(object_id=bytes(16)))
+    assert len(index.object_ids) == 0
+    assert len(index.birth_object_ids) == 0
+    assert index.lookup_object_id(bytes(16)) is None
+
+def test_birth_object_id_fallback():
+    buffer = build_entry(object_id=guid(1), birth_object_id=guid(2)) + \
+        build_entry(object_id=guid(2), birth_object_id=guid(3))
+    index = MFTLookupIndex.from_buffer(buffer)
+    assert index.lookup_object_id(guid(2)) == ENTRY_SIZE
+    assert index.lookup_object_id(guid(3)) == ENTRY_SIZE
+    assert index.lookup_object_id(guid(4), -1) == -1
+    assert index.lookup_object_ids([guid(1), guid(2), guid(3), guid(4)], -1) == \
+        [0, ENTRY_SIZE, ENTRY_SIZE, -1]
+
+def test_batch_lookups_with_missing_and_wrong_length_keys():
+    buffer = b''.join(build_entry(sequence_number=1) for _ in range(4))
+    index = MFTLookupIndex.from_buffer(buffer)
+    assert index.lookup_file_references(
+        [(3, 1), (4, 1), b'\x00' * 4, bytearray(pack_file_reference(0, 1)), (2 << 48) | 2]
+    ) == [3 * ENTRY_SIZE, None, None, 0, None]
+    assert index.lookup_object_ids([b'short', guid(1)]) == [None, None]
+
+def test_invalid_key_types_raise():
+    index = MFTLookupIndex.from_buffer(build_entry())
+    with pytest.raises(TypeError):
+        index.lookup_file_reference('0')
+    with pytest.raises(TypeError):
+        index.lookup_file_references([1.0])
+    with pytest.raises(TypeError):
+        index.lookup_object_id(16)
+    with pytest.raises(TypeError):
+        index.lookup_object_ids([None])
+
+def test_table_grows_past_initial_capacity():
+    table = MFTFixedKeyTable(8, capacity=4)
+    keys = [pack_file_reference(record, 1) for record in range(5000)]
+    for value, key in enumerate(keys):
+        assert table.insert(key, value)
+    assert not table.insert(keys[0], 1234)
+    assert len(table) == 5000
+    assert table.get_many(keys) == list(range(5000))
+    assert table.get(pack_file_reference(5000, 1)) is None
+
+def test_guid_tables_are_not_presized():
+    index = MFTLookupIndex.from_buffer(b''.join(build_entry() for _ in range(4096)))
+    assert index.object_ids._mask < index.file_references._mask
+
+def test_malformed_attributes_do_not_abort_index():
+    ## $OBJECT_ID header near the end of the entry with a record length too short
+    ## to hold the resident attribute header
+    truncated = bytearray(build_entry())
+    struct.pack_into('<IIB', truncated, 0x3F0, 0x40, 8, 0)
+    struct.pack_into('<I', truncated, 0x18, ENTRY_SIZE)
+    struct.pack_into('<H', truncated, 0x14, 0x3F0)
+    ## value offset pointing past the end of the attribute record
+    bad_value_offset = bytearray(24)
+    struct.pack_into('<IIBBHHHIHB', bad_value_offset, 0, 0x40, 24, 0, 0, 0, 0, 0, 64, 0x200, 0)
+    ## first attribute offset past the used size of the entry
+    bad_first_attribute = bytearray(build_entry(object_id=guid(9)))
+    struct.pack_into('<H', bad_first_attribute, 0x14, 0x300)
+    buffer = bytes(truncated) + \
+        build_entry(raw_attribute=bytes(bad_value_offset)) + \
+        bytes(bad_first_attribute) + \
+        build_entry(object_id=guid(7))
+    index = MFTLookupIndex.from_buffer(buffer)
+    assert len(index.object_ids) == 1
+    assert index.lookup_object_id(guid(7)) == 3 * ENTRY_SIZE
+    assert index.lookup_file_references([(0, 1), (1, 1), (2, 1)]) == \
+        [0, ENTRY_SIZE, 2 * ENTRY_SIZE]
+
+def test_from_file(tmp_path):
+    path = tmp_path / 'MFT'
+    path.write_bytes(build_entry() + build_entry(object_id=guid(3)))
+    index = MFTLookupIndex.from_file(str(path))
+    assert index.lookup_object_id(guid(3)) == ENTRY_SIZE
+    empty = tmp_path / 'empty'
+    empty.write_bytes(b'')
+    assert len(MFTLookupIndex.from_file(str(empty)).file_references) == 0